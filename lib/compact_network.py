@@ -0,0 +1,350 @@
+import os
+import json
+import math
+import heapq
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import shapely
+
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from shapely.geometry import Point
+
+# Directory where the arrays of the compact graph are stored, every array is a separate .npy file
+# so that it can be memory-mapped and shared (through the page cache) by all the worker processes.
+# It is a symbolic link to the directory of the current version of the arrays
+GRAPH_DIR = './data/graph'
+ARRAYS = ('offsets', 'targets', 'lengths', 'node_ids', 'node_x', 'node_y')
+
+# Written last into the directory, it marks the arrays as complete and identifies the source graph
+META = 'meta.json'
+
+# Smallest edge length kept in the graph, scipy does not treat zero weighted entries as edges
+MIN_LENGTH = 1e-6
+
+# Approximate length of one degree of latitude, used to turn radiuses in meters into degrees
+METERS_PER_DEGREE = 111320
+
+# The straight line distances guiding the A* search are reduced a little, so that the approximations
+# (degrees to meters, longitudes scaled at the mean latitude) never make them longer than a route
+ESTIMATE_FACTOR = 0.98
+
+
+class CompactGraph:
+    """
+    Description:
+    - Read-only CSR (compressed sparse row) representation of the street network. The outgoing
+      edges of the node i are targets[offsets[i]:offsets[i + 1]] with the matching lengths.
+      Nodes are referred by their position in the arrays, node_ids maps them back to OSM ids.
+
+    Instance variables:
+    - offsets: Array of size n + 1 with the start of the edges of each node.
+    - targets: Array with the target node of each edge.
+    - lengths: Array with the length of each edge in meters.
+    - node_ids: Array with the OSM id of each node.
+    - node_x, node_y: Arrays with the longitude and latitude of each node.
+    """
+    def __init__(self, path=GRAPH_DIR):
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in ARRAYS}
+
+        self.offsets = arrays['offsets']
+        self.targets = arrays['targets']
+        self.lengths = arrays['lengths']
+        self.node_ids = arrays['node_ids']
+        self.node_x = arrays['node_x']
+        self.node_y = arrays['node_y']
+
+        n = len(self.node_ids)
+        self.matrix = csr_matrix((self.lengths, self.targets, self.offsets), shape=(n, n), copy=False)
+
+        self._tree = None
+        self._edge_tree = None
+        self._edge_sources = None
+        self._scale = np.cos(np.radians(float(np.mean(self.node_y))))
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def nearest_nodes(self, xs, ys):
+        _, nodes = self._get_tree().query(self._scaled_points(xs, ys))
+        return nodes
+
+    def candidate_nodes(self, xs, ys, radius=50, k=8):
+        # Up to k nodes within radius meters of each point, missing candidates are marked with -1
+        dists, nodes = self._get_tree().query(self._scaled_points(xs, ys), k=k, distance_upper_bound=radius / METERS_PER_DEGREE)
+        dists, nodes = dists.reshape(len(nodes), k), nodes.reshape(len(nodes), k)
+
+        nodes[np.isinf(dists)] = -1
+        return nodes
+
+    def candidate_edges(self, xs, ys, radius=50, k=8):
+        """
+        Projections of the points on the edges of the graph within radius meters, the k nearest
+        edges of each point are kept. Points without any edge within radius get their nearest edges.
+
+        Parameters:
+            xs, ys (array): Longitudes and latitudes of the points.
+            radius (float): Radius in meters in which the edges are searched.
+            k (int): Maximal number of candidate edges per point.
+
+        Returns:
+            tuple: Arrays with the point, the edge, the fraction of the edge where the point is
+                   projected and the distance in meters to the projection of every candidate,
+                   sorted by point and distance.
+        """
+        tree, sources = self._get_edge_tree(), self.edge_sources()
+        scaled = self._scaled_points(xs, ys)
+        points = shapely.points(scaled)
+
+        point, edge = tree.query(points, predicate='dwithin', distance=radius / METERS_PER_DEGREE)
+
+        far = np.setdiff1d(np.arange(len(scaled)), point)
+        if len(far):
+            nearest_point, nearest_edge = tree.query_nearest(points[far], all_matches=True)
+            point, edge = np.r_[point, far[nearest_point]], np.r_[edge, nearest_edge]
+
+        # Projection of the point on the straight line between the ends of the edge
+        start = self._scaled_points(self.node_x[sources[edge]], self.node_y[sources[edge]])
+        end = self._scaled_points(self.node_x[self.targets[edge]], self.node_y[self.targets[edge]])
+        direction, offset = end - start, scaled[point] - start
+
+        squared = (direction ** 2).sum(axis=1)
+        fraction = np.clip((offset * direction).sum(axis=1) / np.where(squared > 0, squared, 1), 0, 1)
+        distance = np.hypot(*(offset - fraction[:, None] * direction).T) * METERS_PER_DEGREE
+
+        order = np.lexsort((distance, point))
+        point, edge, fraction, distance = point[order], edge[order], fraction[order], distance[order]
+
+        first = np.searchsorted(point, point)
+        keep = np.arange(len(point)) - first < k
+
+        return point[keep], edge[keep], fraction[keep], distance[keep]
+
+    def nearest_node(self, x, y):
+        return int(self.nearest_nodes([x], [y])[0])
+
+    def shortest_path(self, orig_node, target_node, path_nodes=True):
+        if orig_node == target_node:
+            return 0.0, [orig_node] if path_nodes else None
+
+        # A* search that stops at the target, so a short hop only explores the nodes around it.
+        # Nodes can be reopened, the result is the shortest path even if the estimates are not consistent
+        tx, ty = float(self.node_x[target_node]), float(self.node_y[target_node])
+        dist, pred = {orig_node: 0.0}, {}
+        heap = [(0.0, 0.0, orig_node)]
+
+        while heap:
+            _, d, node = heapq.heappop(heap)
+            if node == target_node:
+                break
+            if d > dist[node]:
+                continue
+
+            start, end = int(self.offsets[node]), int(self.offsets[node + 1])
+            for target, length in zip(self.targets[start:end].tolist(), self.lengths[start:end].tolist()):
+                new = d + length
+                if new < dist.get(target, np.inf):
+                    dist[target] = new
+                    pred[target] = node
+                    heapq.heappush(heap, (new + self._estimate(target, tx, ty), new, target))
+        else:
+            raise ValueError(f'No path between nodes {orig_node} and {target_node}')
+
+        path = None
+        if path_nodes:
+            path = [target_node]
+            while path[-1] != orig_node:
+                path.append(pred[path[-1]])
+            path.reverse()
+
+        return dist[target_node], path
+
+    def bounded_search(self, sources, limit):
+        # Distances and predecessors from every source node, nodes further than limit meters are not explored
+        return dijkstra(self.matrix, directed=True, indices=sources, return_predecessors=True, limit=limit)
+
+    def distance(self, origin: Point, destination: Point, path_nodes=True):
+        orig_node, target_node = self.nearest_nodes([origin.x, destination.x], [origin.y, destination.y])
+        return self.shortest_path(int(orig_node), int(target_node), path_nodes)
+
+    def path_coords(self, path):
+        nodes = np.asarray(path, dtype=np.int64)
+        return list(zip(self.node_x[nodes].tolist(), self.node_y[nodes].tolist()))
+
+    def osm_ids(self, path):
+        return self.node_ids[np.asarray(path, dtype=np.int64)].tolist()
+
+    def edge_sources(self):
+        # Source node of every edge, the CSR arrays only keep the targets
+        if self._edge_sources is None:
+            self._edge_sources = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.offsets))
+
+        return self._edge_sources
+
+    def _estimate(self, node, tx, ty):
+        # Straight line distance in meters from the node to the target, never longer than a route
+        dx = (float(self.node_x[node]) - tx) * self._scale
+        dy = float(self.node_y[node]) - ty
+        return math.hypot(dx, dy) * METERS_PER_DEGREE * ESTIMATE_FACTOR
+
+    def _get_edge_tree(self):
+        # Straight lines between the ends of every edge, only built when it is needed for the first time
+        if self._edge_tree is None:
+            sources = self.edge_sources()
+            coords = np.stack((self._scaled_points(self.node_x[sources], self.node_y[sources]),
+                               self._scaled_points(self.node_x[self.targets], self.node_y[self.targets])), axis=1)
+            self._edge_tree = shapely.STRtree(shapely.linestrings(coords))
+
+        return self._edge_tree
+
+    def _get_tree(self):
+        # The tree for snapping is only built when it is needed for the first time
+        if self._tree is None:
+            self._tree = cKDTree(self._scaled_points(self.node_x, self.node_y))
+
+        return self._tree
+
+    def _scaled_points(self, xs, ys):
+        # Longitudes are scaled by cos(latitude) to make the distances in degrees isotropic
+        return np.column_stack((np.asarray(xs, dtype=float) * self._scale, np.asarray(ys, dtype=float)))
+
+
+# -------------------------------------------------------------- #
+#               BUILDING AND LOADING OF THE GRAPH                #
+# -------------------------------------------------------------- #
+
+def build(graph, path=GRAPH_DIR):
+    node_ids, node_x, node_y, u, v, length = _graph_arrays(graph)
+    length = np.maximum(length, MIN_LENGTH)
+
+    # Keep only the shortest of the parallel edges, the same one networkx uses for routing
+    order = np.lexsort((length, v, u))
+    u, v, length = u[order], v[order], length[order]
+
+    keep = np.ones(len(u), dtype=bool)
+    keep[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    u, v, length = u[keep], v[keep], length[keep]
+
+    offsets = np.zeros(len(node_ids) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum(np.bincount(u, minlength=len(node_ids)))
+
+    arrays = {'offsets': offsets, 'targets': v, 'lengths': length,
+              'node_ids': node_ids, 'node_x': node_x, 'node_y': node_y}
+
+    # Every build is written in its own version directory, path is a symbolic link to the current
+    # one that is swapped at once, so no process can find a missing or half written graph
+    digest = fingerprint(graph)
+    parent, name = os.path.split(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    version = tempfile.mkdtemp(dir=parent, prefix=f'.{name}-{digest[:12]}-')
+
+    for array_name, array in arrays.items():
+        np.save(os.path.join(version, f'{array_name}.npy'), array)
+
+    with open(os.path.join(version, META), 'w') as file:
+        json.dump({'fingerprint': digest}, file)
+
+    _publish(version, path)
+    return CompactGraph(version)
+
+def fingerprint(graph):
+    # Hash of the nodes, coordinates and edges of the networkx graph the arrays are built from
+    digest = hashlib.sha1()
+    for array in _graph_arrays(graph):
+        digest.update(np.ascontiguousarray(array).tobytes())
+
+    return digest.hexdigest()
+
+_graph = None
+
+def load(path=GRAPH_DIR, graph=None):
+    """
+    Load the compact graph shared by the processes, building the arrays if they are missing.
+
+    Parameters:
+        path (str): Directory (link to the current version) of the arrays.
+        graph (MultiDiGraph): Source graph, when given the arrays are rebuilt if they were built from another graph.
+
+    Returns:
+        CompactGraph: The graph, loaded once per process.
+    """
+    global _graph
+
+    if _graph is None or graph is not None:
+        version = os.path.realpath(path)
+        meta = _read_meta(version)
+
+        # The version was replaced and removed while it was being read, the new one is read
+        if meta is None and os.path.realpath(path) != version:
+            return load(path, graph)
+
+        if graph is not None and (meta is None or meta.get('fingerprint') != fingerprint(graph)):
+            _graph = build(graph, path)
+        elif meta is None:
+            # Only the first run needs the networkx graph downloaded from OpenStreetMap
+            import lib.network as net
+            _graph = build(net.graph, path)
+        else:
+            try:
+                _graph = CompactGraph(version)
+            except FileNotFoundError:
+                # The version was replaced and removed while it was being loaded, the new one is loaded
+                if os.path.realpath(path) == version:
+                    raise
+                return load(path, graph)
+
+    return _graph
+
+def prepare(path=GRAPH_DIR):
+    # Build (or rebuild stale) arrays once in the parent process, before a pool of workers is started
+    import lib.network as net
+    return load(path, net.graph)
+
+def distance(origin: Point, destination: Point, path_nodes=True):
+    return load().distance(origin, destination, path_nodes)
+
+def path_coords(path):
+    return load().path_coords(path)
+
+
+# ---------------- UTILITY FUNCTIONS ---------------- #
+
+def _graph_arrays(graph):
+    node_ids = np.array(list(graph.nodes), dtype=np.int64)
+    node_x = np.array([graph.nodes[node]['x'] for node in node_ids], dtype=np.float64)
+    node_y = np.array([graph.nodes[node]['y'] for node in node_ids], dtype=np.float64)
+
+    index = {node: i for i, node in enumerate(node_ids.tolist())}
+    edges = [(index[u], index[v], data['length']) for u, v, data in graph.edges(data=True)]
+
+    u = np.array([edge[0] for edge in edges], dtype=np.int32)
+    v = np.array([edge[1] for edge in edges], dtype=np.int32)
+    length = np.array([edge[2] for edge in edges], dtype=np.float64)
+
+    return node_ids, node_x, node_y, u, v, length
+
+def _read_meta(path):
+    try:
+        with open(os.path.join(path, META)) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _publish(version, path):
+    previous = os.path.realpath(path) if os.path.islink(path) else None
+
+    # A directory of the graph built before the versions is moved away, only the first time
+    if os.path.isdir(path) and not os.path.islink(path):
+        previous = f'{version}.legacy'
+        os.replace(path, previous)
+
+    link = f'{version}.link'
+    os.symlink(os.path.basename(version), link)
+    os.replace(link, path)
+
+    # Processes that already mapped the previous version keep their copy of the arrays
+    if previous is not None and previous != version:
+        shutil.rmtree(previous, ignore_errors=True)
@@ -0,0 +1,112 @@
+import numpy as np
+import shapely
+import lib.compact_network as cnet
+
+EMPTY_LINE = shapely.from_wkt('LINESTRING EMPTY')
+
+
+class RaggedPaths:
+    """
+    Description:
+    - Paths of nodes of the compact graph stored as one flat array of nodes and the offsets
+      of every path in it, so that the geometries of all of them are created in one call.
+      A path can have a fallback point, used as its geometry when it has less than two nodes.
+      Paths are added as lists of nodes, the arrays are only built again after they changed.
+
+    Instance variables:
+    - nodes: Flat array with the nodes of all the paths.
+    - offsets: Array of size len + 1 with the start of every path in nodes.
+    - fallback: Array (len, 2) with the fallback x, y of every path (nan if there is none).
+    """
+    def __init__(self):
+        self._nodes = []
+        self._offsets = [0]
+        self._fallback = []
+        self._arrays = None
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        nodes, offsets = self.nodes, self.offsets
+        return nodes[offsets[index]:offsets[index + 1]]
+
+    def append(self, path, fallback=None):
+        self._nodes.extend(path if path is not None else [])
+        self._offsets.append(len(self._nodes))
+        self._fallback.append((fallback.x, fallback.y) if fallback is not None else (np.nan, np.nan))
+        self._arrays = None
+
+    def extend(self, path):
+        # Continue the last path with a path starting at its last node, the shared node is kept once
+        if self._offsets[-1] > self._offsets[-2]:
+            self._nodes.pop()
+
+        self._nodes.extend(path)
+        self._offsets[-1] = len(self._nodes)
+        self._arrays = None
+
+    @property
+    def nodes(self):
+        return self._get_arrays()[0]
+
+    @property
+    def offsets(self):
+        return self._get_arrays()[1]
+
+    @property
+    def fallback(self):
+        return self._get_arrays()[2]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def to_geometries(self, graph=None):
+        return path_geometries(self, graph)
+
+    def _get_arrays(self):
+        # The arrays are only built again after the paths changed
+        if self._arrays is None:
+            self._arrays = (np.asarray(self._nodes, dtype=np.int64),
+                            np.asarray(self._offsets, dtype=np.int64),
+                            np.asarray(self._fallback, dtype=np.float64).reshape(len(self), 2))
+
+        return self._arrays
+
+
+def path_geometries(paths: RaggedPaths, graph=None):
+    """
+    Create the geometries of all the paths at once from the node coordinate arrays of the graph.
+
+    Parameters:
+        paths (RaggedPaths): Paths of nodes of the compact graph.
+        graph (CompactGraph): Graph of the nodes, the shared compact graph is used when not given.
+
+    Returns:
+        ndarray: LineString of every path with at least two nodes, otherwise its fallback point
+                 or an empty LineString when it has no fallback.
+    """
+    geoms = np.full(len(paths), None, dtype=object)
+
+    if len(paths) == 0:
+        return geoms
+
+    nodes, lengths, fallback = paths.nodes, paths.lengths(), paths.fallback
+
+    # All the lines are created with a single call from the flat coordinates, the graph
+    # is only needed (and loaded) when there is a line
+    lines = lengths > 1
+    in_lines = np.repeat(lines, lengths)
+    if lines.any():
+        graph = cnet.load() if graph is None else graph
+        coords = np.column_stack((graph.node_x[nodes[in_lines]], graph.node_y[nodes[in_lines]]))
+        indices = np.repeat(np.arange(lines.sum()), lengths[lines])
+        geoms[lines] = shapely.linestrings(coords, indices=indices)
+
+    has_fallback = ~lines & ~np.isnan(fallback[:, 0])
+    geoms[has_fallback] = shapely.points(fallback[has_fallback])
+
+    # Shorter paths without fallback have no line, they get the (immutable) empty line
+    geoms[~lines & ~has_fallback] = EMPTY_LINE
+
+    return geoms
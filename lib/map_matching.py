@@ -0,0 +1,202 @@
+import numpy as np
+import lib.compact_network as cnet
+
+from collections import OrderedDict
+
+EARTH_RADIUS = 6371000
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = (np.radians(np.asarray(a, dtype=float)) for a in (lon1, lat1, lon2, lat2))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class SearchCache:
+    """
+    Description:
+    - Keeps the results of the last bounded searches of the road graph so that the candidates
+      shared by consecutive fixes (e.g. a parked phone) are not searched again.
+
+    Instance variables:
+    - graph: CompactGraph that is searched.
+    - size: Maximal number of source nodes whose searches are kept.
+    - searches: Ordered mapping source node -> (limit, distances, predecessors).
+    """
+    def __init__(self, graph, size=32):
+        self.graph = graph
+        self.size = size
+        self.searches = OrderedDict()
+
+    def search(self, sources, limit):
+        # Only the sources without a search that covers the limit are searched again
+        missing = [s for s in sources if s not in self.searches or self.searches[s][0] < limit]
+
+        if missing:
+            dists, preds = self.graph.bounded_search(missing, limit)
+            for i, source in enumerate(missing):
+                self.searches[source] = (limit, dists[i], preds[i])
+
+        for source in sources:
+            self.searches.move_to_end(source)
+
+        # Drop the oldest searches, the ones asked now are always kept
+        while len(self.searches) > max(self.size, len(sources)):
+            self.searches.popitem(last=False)
+
+        return [self.searches[s] for s in sources]
+
+
+def path_from(pred, source, target):
+    path = [target]
+
+    while path[-1] != source:
+        path.append(int(pred[path[-1]]))
+
+    path.reverse()
+    return path
+
+
+def match_trajectory(pfs, radius=50, sigma=10, beta=50, k=8, graph=None):
+    """
+    Match a trajectory to the road network with a Hidden Markov Model solved by Viterbi.
+    The candidates of every fix are its projections on the nearby edges, so a fix in the
+    middle of a street is matched on the street and not on the nearest intersection.
+
+    Parameters:
+        pfs (Positionfixes): Position fixes of one user (e.g. a single day), sorted by time.
+        radius (float): Radius in meters in which the candidate edges of each fix are searched.
+        sigma (float): Standard deviation in meters of the GPS noise (emission probabilities).
+        beta (float): Scale in meters of the difference between route and straight line distance (transitions).
+        k (int): Maximal number of candidate edges per fix.
+        graph (CompactGraph): Road graph, the shared compact graph is used when not given.
+
+    Returns:
+        tuple: Matched position (source node, target node, fraction of the edge) of every fix, and
+               for every pair of adjacent fixes the route distance and the path of nodes through the
+               ends of the matched edges (None where no route was found).
+    """
+    graph = cnet.load() if graph is None else graph
+    cache = SearchCache(graph)
+
+    xs = pfs['geom'].x.to_numpy()
+    ys = pfs['geom'].y.to_numpy()
+    n = len(xs)
+
+    if n == 0:
+        return [], [], []
+
+    # Candidates of every fix: edge, its ends, its length, the fraction where the fix is projected
+    point, edge, fraction, offset = graph.candidate_edges(xs, ys, radius, k)
+    bounds = np.searchsorted(point, np.arange(n + 1))
+    sources = graph.edge_sources()
+
+    cands = []
+    for i in range(n):
+        e = edge[bounds[i]:bounds[i + 1]]
+        cands.append((e, sources[e], graph.targets[e], graph.lengths[e], fraction[bounds[i]:bounds[i + 1]]))
+
+    def emission(i):
+        return -0.5 * (offset[bounds[i]:bounds[i + 1]] / sigma) ** 2
+
+    straight = haversine(xs[:-1], ys[:-1], xs[1:], ys[1:])
+
+    # Viterbi over the candidates, back[i][j] is the best previous candidate of the candidate j of fix i
+    score = emission(0)
+    back = [None]
+    routes = [None]
+    ends = {}
+
+    for i in range(1, n):
+        prev, curr = cands[i - 1], cands[i]
+
+        # The route between candidates is bounded, longer detours are not plausible
+        limit = 2 * straight[i - 1] + 4 * radius
+        exits, rows = np.unique(prev[2], return_inverse=True)
+        searches = cache.search(exits.tolist(), limit)
+
+        route, same = _routes(prev, curr, np.array([s[1][curr[1]] for s in searches])[rows], sigma)
+        trans = np.where(np.isinf(route), -np.inf, -np.abs(route - straight[i - 1]) / beta)
+
+        total = score[:, None] + trans
+        best = np.argmax(total, axis=0)
+        best_score = total[best, np.arange(len(curr[0]))]
+
+        if np.all(np.isinf(best_score)):
+            # No candidate is reachable, the chain is broken and starts again from this fix
+            ends[i - 1] = score
+            score = emission(i)
+            back.append(None)
+            routes.append(None)
+            continue
+
+        routes.append([(route[b, j], _edge_path(prev, curr, b, j, same[b, j], searches[rows[b]][2]))
+                       if np.isfinite(route[b, j]) else (None, None) for j, b in enumerate(best)])
+        back.append(best)
+        score = best_score + emission(i)
+
+    # Backtracking of the most likely candidates, every broken chain is ended at its own best candidate
+    chosen = [0] * n
+    j = int(np.argmax(score))
+
+    for i in range(n - 1, -1, -1):
+        chosen[i] = j
+        if i > 0:
+            j = int(np.argmax(ends[i - 1])) if back[i] is None else int(back[i][j])
+
+    matched = [(int(cands[i][1][chosen[i]]), int(cands[i][2][chosen[i]]), float(cands[i][4][chosen[i]]))
+               for i in range(n)]
+
+    distances, paths = [], []
+    for i in range(1, n):
+        dist, path = routes[i][chosen[i]] if routes[i] is not None else (None, None)
+
+        # Chain breaks are routed without bound between the matched edges
+        if path is None:
+            dist, path = _unbounded_route(graph, cands[i - 1], cands[i], chosen[i - 1], chosen[i], sigma)
+
+        distances.append(None if dist is None else float(dist))
+        paths.append(path)
+
+    return matched, distances, paths
+
+
+# ---------------- UTILITY FUNCTIONS ---------------- #
+
+def _routes(prev, curr, between, tolerance):
+    # Route distances between all the candidates of two fixes, between are the distances from the
+    # target node of the previous edges to the source node of the current ones
+    _, _, _, prev_length, prev_fraction = prev
+    edge, _, _, length, fraction = curr
+
+    route = ((1 - prev_fraction) * prev_length)[:, None] + between + (fraction * length)[None, :]
+
+    # Moving forward on the same edge does not leave it, GPS noise moving a fix back by less
+    # than tolerance meters on the same edge is not a U-turn but no movement
+    moved = (fraction[None, :] - prev_fraction[:, None]) * prev_length[:, None]
+    same = (prev[0][:, None] == edge[None, :]) & (moved >= -tolerance)
+    route = np.where(same, np.maximum(moved, 0), route)
+
+    return route, same
+
+def _edge_path(prev, curr, b, j, same, pred):
+    # Nodes from the source of the previous edge to the target of the current one
+    if same:
+        return [int(prev[1][b]), int(prev[2][b])] if curr[4][j] > prev[4][b] else []
+
+    return [int(prev[1][b])] + path_from(pred, int(prev[2][b]), int(curr[1][j])) + [int(curr[2][j])]
+
+def _unbounded_route(graph, prev, curr, b, j, tolerance):
+    prev, curr = tuple(a[[b]] for a in prev), tuple(a[[j]] for a in curr)
+
+    route, same = _routes(prev, curr, np.zeros((1, 1)), tolerance)
+    if same[0, 0]:
+        return route[0, 0], _edge_path(prev, curr, 0, 0, True, None)
+
+    try:
+        between, nodes = graph.shortest_path(int(prev[2][0]), int(curr[1][0]))
+    except ValueError:
+        return None, None
+
+    return route[0, 0] + between, [int(prev[1][0])] + nodes + [int(curr[2][0])]
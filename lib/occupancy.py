@@ -0,0 +1,244 @@
+import io
+import asyncio
+import numpy as np
+import pandas as pd
+import lib.density_analysis as da
+
+from collections import OrderedDict
+from shapely import STRtree, points
+
+# Columns of the raw fixes, the same ones read by process.read_positionfixes
+RAW_COLUMNS = ['identifier', 'timestamp', 'device_lat', 'device_lon']
+COLUMNS = {'identifier': 'user_id', 'timestamp': 'tracked_at',
+           'device_lat': 'latitude', 'device_lon': 'longitude'}
+
+EPOCH = pd.Timestamp(0, tz='UTC')
+
+
+class OccupancyEstimator:
+    """
+    Description:
+    - Near real-time occupancy of the red line polygons. Fixes are matched to the buffered red
+      line polygons and every polygon keeps the devices seen inside it during the last window
+      seconds. Devices keep the polygon they are in and since when, idle devices are expired.
+      The clock is the time of the ingested fixes, so a replay of old data behaves the same.
+
+    Instance variables:
+    - polygon_ids: Ids of the red line polygons.
+    - window: Length in seconds of the sliding window of the occupancy.
+    - idle_timeout: Seconds after which a device without any fix is forgotten.
+    - now: Time (epoch seconds) of the latest ingested fix.
+    - devices: Ordered mapping device -> [polygon id or None, entered_at, last_seen], oldest first.
+    - presence: Mapping polygon id -> ordered mapping device -> last time seen inside, oldest first.
+    """
+    def __init__(self, polygons=da.rl_polygons, buffer=0.5, window=900, idle_timeout=1800):
+        polygons = da.create_buffer(polygons, buffer, 'geom')
+        polygons = polygons[~polygons.geometry.is_empty]
+
+        self.polygon_ids = polygons['id'].tolist()
+        self.tree = STRtree(polygons.geometry.values)
+
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self.now = float('-inf')
+
+        self.devices = OrderedDict()
+        self.presence = {pid: OrderedDict() for pid in self.polygon_ids}
+
+    def match(self, lon, lat):
+        # Index of the polygon each point is inside, -1 for points outside of every polygon
+        matched = np.full(len(lon), -1)
+        pairs = self.tree.query(points(lon, lat), predicate='within')
+
+        # A point inside overlapping polygons belongs to the first of them
+        first, index = np.unique(pairs[0], return_index=True)
+        matched[first] = pairs[1][index]
+
+        return matched
+
+    def ingest(self, user_ids, timestamps, lon, lat):
+        # Ingest a batch of fixes, timestamps are epoch seconds
+        matched = self.match(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        order = np.argsort(timestamps, kind='stable')
+
+        for i in order.tolist():
+            polygon = self.polygon_ids[matched[i]] if matched[i] >= 0 else None
+            self._update(user_ids[i], float(timestamps[i]), polygon)
+
+        self.expire()
+
+    def ingest_frame(self, df):
+        # Epoch seconds independent of the resolution of the parsed datetimes
+        timestamps = ((pd.to_datetime(df['tracked_at'], utc=True) - EPOCH) / pd.Timedelta(seconds=1)).to_numpy()
+        self.ingest(df['user_id'].tolist(), timestamps, df['longitude'].to_numpy(), df['latitude'].to_numpy())
+
+    def expire(self, now=None):
+        now = self.now if now is None else now
+
+        # Devices without any fix for too long are not parked anymore
+        while self.devices:
+            uid, (polygon, _, last_seen) = next(iter(self.devices.items()))
+            if last_seen >= now - self.idle_timeout:
+                break
+
+            self.devices.popitem(last=False)
+            if polygon is not None:
+                self.presence[polygon].pop(uid, None)
+
+        # Devices seen in a polygon before the window do not count for its occupancy
+        for devices in self.presence.values():
+            while devices and next(iter(devices.values())) < now - self.window:
+                devices.popitem(last=False)
+
+    # ---------------- QUERY API ---------------- #
+
+    def occupancy(self, polygon_id):
+        return len(self.presence[polygon_id])
+
+    def counts(self):
+        return {pid: len(devices) for pid, devices in self.presence.items() if devices}
+
+    def dwell(self, user_id):
+        # Seconds the device has been inside its current polygon, None if it is outside of all
+        state = self.devices.get(user_id)
+
+        if state is None or state[0] is None:
+            return None
+
+        return state[2] - state[1]
+
+    def snapshot(self):
+        rows = []
+
+        for pid, devices in self.presence.items():
+            dwells = [self.dwell(uid) for uid in devices if self.devices.get(uid, [None])[0] == pid]
+            rows.append({
+                'polygon_id': pid,
+                'occupancy': len(devices),
+                'inside': len(dwells),
+                'mean_dwell': np.mean(dwells) if dwells else 0.0,
+            })
+
+        return pd.DataFrame(rows)
+
+    # ---------------- UTILITY FUNCTIONS ---------------- #
+
+    def _update(self, uid, ts, polygon):
+        self.now = max(self.now, ts)
+        state = self.devices.pop(uid, None)
+
+        if state is None or state[0] != polygon:
+            state = [polygon, ts, ts]
+        else:
+            state[2] = max(state[2], ts)
+
+        self.devices[uid] = state
+
+        if polygon is not None:
+            devices = self.presence[polygon]
+            devices.pop(uid, None)
+            devices[uid] = ts
+
+
+# -------------------------------------------------------------- #
+#                        INGESTION SOURCES                       #
+# -------------------------------------------------------------- #
+
+def parse_lines(lines, header=RAW_COLUMNS):
+    # Parse raw csv lines into a frame with the positionfixes column names
+    df = pd.read_csv(io.StringIO('\n'.join(lines)), names=header, usecols=RAW_COLUMNS)
+    return df.rename(columns=COLUMNS)
+
+async def queue_source(queue: asyncio.Queue):
+    # Frames or lists of csv lines put in an in-process queue, None ends the stream
+    while True:
+        batch = await queue.get()
+        if batch is None:
+            return
+
+        yield batch if isinstance(batch, pd.DataFrame) else parse_lines(batch)
+
+async def tail_file(path, poll=0.5, follow=True):
+    # Lines appended to a raw csv file, the first line is the header (it may not be written yet)
+    with open(path) as file:
+        header = None
+        partial = ''
+
+        while True:
+            # The file is read in a thread so the event loop is never blocked,
+            # a line that is still being written is kept until it is complete
+            lines = (partial + await asyncio.to_thread(file.read)).split('\n')
+            partial = lines.pop()
+
+            if header is None and lines:
+                header = lines.pop(0).strip().split(',')
+
+            lines = [line for line in lines if line.strip()]
+
+            if lines:
+                yield parse_lines(lines, header)
+            elif not follow:
+                return
+            else:
+                await asyncio.sleep(poll)
+
+async def replay_csv(path, batch_size=1000, speed=None):
+    # Replay of a raw csv file, with speed the original time between the batches is divided by speed
+    previous = None
+
+    for df in pd.read_csv(path, usecols=RAW_COLUMNS, chunksize=batch_size):
+        df = df.rename(columns=COLUMNS)
+
+        if speed:
+            start = pd.to_datetime(df['tracked_at'], utc=True).min()
+            if previous is not None:
+                await asyncio.sleep(max((start - previous).total_seconds(), 0) / speed)
+            previous = start
+
+        yield df
+        await asyncio.sleep(0)
+
+async def unix_socket_source(path, batch_size=1000, flush=0.5):
+    # Raw csv lines (without header) written by any number of clients to a UNIX socket,
+    # the lines of a client are sent in batches of batch_size or after flush idle seconds
+    queue = asyncio.Queue()
+
+    async def handle(reader, writer):
+        lines = []
+
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), flush)
+            except asyncio.TimeoutError:
+                line = None
+
+            if line == b'':
+                break
+
+            if line and line.strip():
+                lines.append(line.decode().strip())
+
+            if lines and (line is None or len(lines) >= batch_size):
+                await queue.put(lines)
+                lines = []
+
+        if lines:
+            await queue.put(lines)
+        writer.close()
+
+    server = await asyncio.start_unix_server(handle, path=path)
+
+    async with server:
+        async for batch in queue_source(queue):
+            yield batch
+
+async def run(estimator: OccupancyEstimator, source):
+    # Ingest every batch of the source into the estimator, returns the number of ingested fixes
+    ingested = 0
+
+    async for batch in source:
+        if not batch.empty:
+            estimator.ingest_frame(batch)
+            ingested += len(batch)
+
+    return ingested
@@ -1,14 +1,27 @@
-from shapely.geometry import LineString
+from shapely import contains_xy
 from pyproj import CRS
 from tqdm import tqdm
+from pandas.api.types import union_categoricals
 
-import lib.network as net
+import lib.compact_network as cnet
+import lib.geometry as geo
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 import trackintel as ti
 
 yvn_polygon = gpd.read_file('./polygons/yerevan/yerevan.shp').set_crs('EPSG:4326')
 
+# Coordinates of the compact positionfixes in fixed-point are stored in units of 1e-7 degrees (about 1cm)
+COORD_SCALE = 10 ** 7
+
+# Estimated memory of one shapely geometry (python object and GEOS storage), not visible to pandas.
+# Measured from the growth of the process memory when creating a million geometries (GEOS 3.14)
+POINT_BYTES = 200
+GEOMETRY_BYTES = 100
+COORD_BYTES = 30
+
 class Person:
     """
     Description:
@@ -75,7 +88,8 @@ class Person:
         self.sp = pd.concat([item[1] for item in sp_days])
         
     def generate_triplegs(self):
-        triplegs = pd.DataFrame(columns=['user_id', 'started_at', 'finished_at', 'distance', 'geom'])
+        triplegs = []
+        paths = geo.RaggedPaths()
 
         pfs_days = self.group_pfs_by_date()
         sp_days = self.group_sp_by_date()
@@ -85,27 +99,29 @@ class Person:
             sp = sp_days[index].sort_values(by='started_at')
 
             if (len(sp) <= 1):
-                dist, path = self._distance_in_between(day)
-                tripleg = self._create_tripleg(day, dist, path)
-                triplegs.loc[len(triplegs)] = tripleg
+                dist = self._distance_in_between(day, paths)
+                triplegs.append(self._create_tripleg(day, dist))
                 continue
 
             for pos in range(len(sp) - 1):
-                dist, path = self._distance_in_between(day, sp, pos)         
-                tripleg = self._create_tripleg(day, dist, path, sp, pos)
-
-                triplegs.loc[len(triplegs)] = tripleg
+                dist = self._distance_in_between(day, paths, sp, pos)
+                triplegs.append(self._create_tripleg(day, dist, sp, pos))
         
-        triplegs = triplegs.set_geometry('geom')
+        # The LineStrings of all the shortest paths are created at once
+        triplegs = pd.DataFrame(triplegs, columns=['user_id', 'started_at', 'finished_at', 'distance'])
+        triplegs['geom'] = paths.to_geometries()
+
+        triplegs = gpd.GeoDataFrame(triplegs, geometry='geom')
         self.tpls = ti.Triplegs(triplegs)
     
 
     
     # ---------------- UTILITY FUNCTIONS ---------------- #
     
-    def _distance_in_between(self, pfs, sp=None, pos=-1):
+    def _distance_in_between(self, pfs, paths, sp=None, pos=-1):
+        # The shortest paths between the fixes are joined into a new path at the end of paths
         dist = 0
-        path = list()
+        paths.append([])
 
         if (sp is not None) and (pos != -1):
             pfs = pfs[(pfs['tracked_at'] >= sp.iloc[pos]['started_at']) & (pfs['tracked_at'] < sp.iloc[pos+1]['finished_at'])]
@@ -113,18 +129,14 @@ class Person:
         for i in range(len(pfs) - 1):
             first = pfs.iloc[i]['geom']
             second = pfs.iloc[i+1]['geom']
-            distance, shortest_path = net.distance(first, second)
+            distance, shortest_path = cnet.distance(first, second)
 
             dist += distance
-            path = path[:-1] + shortest_path
+            paths.extend(shortest_path)
         
-        return dist, path
+        return dist
     
-    def _create_tripleg(self, day, dist, path, sp=None, pos=-1):
-        # Create LineString from the shortest paths
-        path_coord = [(net.graph.nodes[node]['x'], net.graph.nodes[node]['y']) for node in path]
-        path = LineString(path_coord)
-
+    def _create_tripleg(self, day, dist, sp=None, pos=-1):
         # Creaet the geometry of the origin and destination
         if (sp is not None) and (pos != -1):
             start = sp.iloc[pos]['finished_at']
@@ -138,12 +150,82 @@ class Person:
             'started_at': start,
             'finished_at': end,
             'distance': dist,
-            'geom': path,
         }
 
         return tripleg
 
 
+class PeopleStore:
+    """
+    Description:
+    - Holds the position fixes and staypoints of all the people in two global tables, so that
+      the operations on the whole population are done once instead of once per person.
+      Iterating or indexing the store gives the Person objects of the tables, a person is only
+      built when it is accessed and then kept, so the state set on it (e.g. triplegs) is not lost.
+      When the tables change, the people already built are updated on their next access.
+
+    Instance variables:
+    - pfs: Positionfixes of all the people, sorted by user_id and timestamp.
+    - sp: Staypoints of all the people, sorted by user_id and start time (None if not generated).
+    - ids: Ids of the people in the store.
+    """
+    def __init__(self, pfs: ti.Positionfixes, sp: ti.Staypoints = None, people=None):
+        self._people = {person.id: person for person in people} if people is not None else {}
+        self._filled = {}
+        self._version = 0
+
+        self.set_tables(pfs, sp)
+
+    @classmethod
+    def from_people(cls, people):
+        # The given Person objects are the ones kept by the store
+        pfs = pd.concat([person.pfs for person in people])
+        sps = [person.sp for person in people if person.sp is not None]
+
+        return cls(pfs, pd.concat(sps) if sps else None, people)
+
+    def set_tables(self, pfs: ti.Positionfixes, sp: ti.Staypoints = None):
+        self.pfs = pfs.sort_values(by=['user_id', 'tracked_at'], kind='stable')
+        self.sp = sp.sort_values(by=['user_id', 'started_at'], kind='stable') if sp is not None else None
+
+        self._pfs_groups = self.pfs.groupby('user_id', sort=True).indices
+        self._sp_groups = self.sp.groupby('user_id', sort=True).indices if sp is not None else {}
+        self.ids = list(self._pfs_groups.keys())
+
+        # The people already built are not updated now but on their next access
+        self._version += 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for uid in self.ids:
+            yield self.get(uid)
+
+    def __getitem__(self, index):
+        return self.get(self.ids[index])
+
+    def get(self, uid):
+        if uid not in self._pfs_groups:
+            raise KeyError(uid)
+
+        if uid not in self._people:
+            self._people[uid] = Person(uid, self.pfs.iloc[:0])
+
+        person = self._people[uid]
+        if self._filled.get(uid) != self._version:
+            self._fill(person)
+
+        return person
+
+    def _fill(self, person):
+        person.pfs = self.pfs.take(self._pfs_groups[person.id])
+        person.sp = self.sp.take(self._sp_groups[person.id]) if person.id in self._sp_groups else None
+        self._filled[person.id] = self._version
+
+        return person
+
+
 # -------------------------------------------------------------- #
 #                  MAIN PRE-PROCESSING FUNCTIONS                 #
 # -------------------------------------------------------------- #
@@ -157,6 +239,87 @@ def read_positionfixes(file_path):
         file_path, usecols=usecols, columns=columns, sep=",", tz='UTC', index_col=None, crs=CRS.from_epsg(4326)
     )
 
+def read_compact_positionfixes(file_paths, fixed_point=False):
+    """
+    Read raw position fixes into the compact in-memory schema: categorical user_id, float32
+    (or fixed-point int32) latitude and longitude and int64 epoch seconds in tracked_at,
+    without any geometry. The full Positionfixes are built with to_positionfixes when needed.
+
+    Parameters:
+        file_paths (str or list): Path of one raw csv file or a list of paths.
+        fixed_point (bool): Store the coordinates as int32 in units of 1/COORD_SCALE degrees.
+
+    Returns:
+        DataFrame: Compact position fixes with user_id, tracked_at, latitude and longitude columns.
+    """
+    paths = [file_paths] if isinstance(file_paths, str) else list(file_paths)
+    frames = [_read_compact_csv(path, fixed_point) for path in paths]
+
+    # The categories of all the files are united so that the concatenation stays categorical
+    categories = union_categoricals([frame['user_id'] for frame in frames]).categories
+    for frame in frames:
+        frame['user_id'] = frame['user_id'].cat.set_categories(categories)
+
+    return pd.concat(frames, ignore_index=True)
+
+def compact_positionfixes(pfs: ti.Positionfixes, fixed_point=False):
+    lat, lon = pfs['geom'].y.to_numpy(), pfs['geom'].x.to_numpy()
+
+    compact = pd.DataFrame({
+        'user_id': pfs['user_id'].astype('category').array,
+        'tracked_at': _epoch_seconds(pfs['tracked_at']),
+        'latitude': lat,
+        'longitude': lon,
+    })
+
+    return _downcast_coordinates(compact, fixed_point)
+
+def to_positionfixes(compact):
+    # Full Positionfixes (string ids, tz-aware timestamps and point geometries) from the compact schema
+    lat, lon = _coordinates(compact)
+
+    gdf = gpd.GeoDataFrame({
+        'user_id': compact['user_id'].astype(str).to_numpy(),
+        'tracked_at': pd.to_datetime(compact['tracked_at'].to_numpy(), unit='s', utc=True),
+    }, geometry=gpd.points_from_xy(lon, lat), crs=CRS.from_epsg(4326))
+
+    return ti.Positionfixes(gdf.rename_geometry('geom'))
+
+def memory_report(df, rows=None):
+    """
+    Memory used by each column of a frame, with the projection of the memory for rows fixes.
+
+    Parameters:
+        df (DataFrame): Position fixes in any schema.
+        rows (int): Number of fixes to project the memory for (e.g. a year of fixes).
+
+    Returns:
+        DataFrame: dtype, bytes and bytes per row of every column and the total, in MB.
+                   Rows marked as estimated include the estimated memory of shapely geometries.
+    """
+    usage = df.memory_usage(deep=True)
+    dtypes = df.dtypes.astype(str).reindex(usage.index).fillna('')
+    estimated = pd.Series(False, index=usage.index)
+
+    # pandas only counts the pointers of geometries, their memory is estimated from their size
+    for col in df.columns:
+        if _is_geometry_column(df[col]):
+            values = np.asarray(df[col].values, dtype=object)
+            usage[col] = values.nbytes + _geometry_bytes(values)
+            estimated[col] = True
+
+    report = pd.DataFrame({'dtype': dtypes, 'bytes': usage, 'estimated': estimated})
+    report.loc['total'] = ['', usage.sum(), estimated.any()]
+
+    report['bytes_per_row'] = report['bytes'] / max(len(df), 1)
+    report['MB'] = report['bytes'] / 2 ** 20
+
+    # Categories grow with the number of users, not fixes, so the projection is an upper bound for them
+    if rows is not None:
+        report['projected_MB'] = report['bytes_per_row'] * rows / 2 ** 20
+
+    return report
+
 def extract_people(pfs: ti.Positionfixes):
     people = []
 
@@ -171,39 +334,49 @@ def extract_people(pfs: ti.Positionfixes):
     return people
 
 def update_staypoints(people, sp):
-    grouped = sp.groupby('user_id')
+    # Attach the staypoints to the people with one join on user_id instead of one lookup per person,
+    # the given people (a list of Person or a PeopleStore) are updated in place and returned
+    store = people if isinstance(people, PeopleStore) else PeopleStore.from_people(people)
+    store.set_tables(store.pfs, sp[sp['user_id'].isin(store.ids)])
+
+    # The people of a list are not accessed through the store, so they are updated now
+    if store is not people:
+        for person in people:
+            store.get(person.id)
 
-    for person in people:
-        if person.id in grouped.groups:
-            person.sp = grouped.get_group(person.id)
+    return people
 
 def clean_staypoints(people):
-    cln_people = []
+    # The result is the people store of the cleaned tables, its Person objects are only built when accessed
+    store = people if isinstance(people, PeopleStore) else PeopleStore.from_people(people)
+    pfs, sp = store.pfs, store.sp
 
-    for person in tqdm(people, colour='Green', desc='People Cleaned: '):
-        sp = person.sp
-        pfs = person.pfs
+    # Number of staypoints of each user on each day, computed once for the whole population
+    sp_days = sp['started_at'].dt.normalize()
+    counts = sp.groupby([sp['user_id'], sp_days]).size()
+    removed = counts[counts == 1].index
 
-        sp['count'] = sp['started_at'].dt.date.map(sp['started_at'].dt.date.value_counts())
-        dates_removed = sp[sp['count'] == 1]['started_at'].dt.date.unique()
+    # Anti-join of the (user, day) pairs with a single staypoint on both tables
+    sp_keys = pd.MultiIndex.from_arrays([sp['user_id'], sp_days])
+    pfs_keys = pd.MultiIndex.from_arrays([pfs['user_id'], pfs['tracked_at'].dt.normalize()])
 
-        # Remove positionfixes with dates in dates_removed
-        pfs = pfs[~pfs['tracked_at'].dt.date.isin(dates_removed)]
+    sp = sp[~sp_keys.isin(removed)]
+    pfs = pfs[~pfs_keys.isin(removed)]
 
-        # Remove the unneccessary staypoints
-        sp = sp[sp['count'] > 1]
-        sp.drop(columns=['count'], inplace=True)
+    # Only people left with both positionfixes and staypoints are kept, as the same Person objects
+    users = pd.Index(pfs['user_id'].unique()).intersection(sp['user_id'].unique())
+    store.set_tables(pfs[pfs['user_id'].isin(users)], sp[sp['user_id'].isin(users)])
 
-        # Update the pfs and staypoints
-        if not pfs.empty and not sp.empty:
-            person.pfs = pfs
-            person.sp = sp
-            cln_people.append(person)
-        
-    return cln_people
-        
+    return store
 
 def filter_yerevan_data(pfs: ti.Positionfixes):
+    # Compact position fixes are filtered on their coordinates, without building any geometry
+    if 'geom' not in pfs.columns:
+        lat, lon = _coordinates(pfs)
+        inside = contains_xy(yvn_polygon.union_all(), lon, lat)
+
+        return pfs[inside].reset_index(drop=True)
+
     gdf = gpd.GeoDataFrame(pfs, crs=yvn_polygon.crs, geometry='geom')
     points_in_yvn = gpd.sjoin(yvn_polygon, gdf, predicate='contains')
 
@@ -213,4 +386,62 @@ def filter_yerevan_data(pfs: ti.Positionfixes):
     return filtered_pfs.reset_index(drop=True)
 
 
+
+# ---------------- UTILITY FUNCTIONS ---------------- #
+
+def _read_compact_csv(file_path, fixed_point):
+    usecols = ['identifier', 'timestamp', 'device_lat', 'device_lon']
+    columns = {'identifier': 'user_id', 'timestamp': 'tracked_at',
+               'device_lat': 'latitude', 'device_lon': 'longitude'}
+
+    dtype = {'identifier': 'category', 'device_lat': 'float64', 'device_lon': 'float64'}
+    df = pd.read_csv(file_path, usecols=usecols, dtype=dtype, sep=",").rename(columns=columns)
+
+    df['tracked_at'] = _epoch_seconds(pd.to_datetime(df['tracked_at'], utc=True))
+
+    return _downcast_coordinates(df[['user_id', 'tracked_at', 'latitude', 'longitude']], fixed_point)
+
+def _is_geometry_column(column, sample=100):
+    # Only geometry and object columns can hold geometries, object columns are checked on a sample first
+    if isinstance(column.dtype, gpd.array.GeometryDtype):
+        return True
+
+    if column.dtype != object or column.empty:
+        return False
+
+    values = column.to_numpy()
+    return bool(shapely.is_geometry(values[:sample]).all() and shapely.is_geometry(values).all())
+
+def _geometry_bytes(values):
+    # Estimated memory of the geometries, points have a fixed size and the others grow with their coordinates
+    geoms = values[~pd.isna(values)]
+    points = shapely.get_type_id(geoms) == 0
+    coords = shapely.get_num_coordinates(geoms[~points])
+
+    return int(points.sum() * POINT_BYTES + len(coords) * GEOMETRY_BYTES + coords.sum() * COORD_BYTES)
+
+def _epoch_seconds(tracked_at):
+    # Independent of the resolution (ns, us, s) of the datetimes
+    return ((tracked_at - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)).to_numpy(dtype=np.int64)
+
+def _downcast_coordinates(df, fixed_point):
+    for col in ['latitude', 'longitude']:
+        if fixed_point:
+            df[col] = np.round(df[col].to_numpy() * COORD_SCALE).astype(np.int32)
+        else:
+            df[col] = df[col].astype(np.float32)
+
+    return df
+
+def _coordinates(compact):
+    # Latitude and longitude in float64 degrees, whatever the storage of the compact schema is
+    lat = compact['latitude'].to_numpy()
+    lon = compact['longitude'].to_numpy()
+
+    if np.issubdtype(lat.dtype, np.integer):
+        return lat / COORD_SCALE, lon / COORD_SCALE
+
+    return lat.astype(np.float64), lon.astype(np.float64)
+
+
 # //TODO: Work from parking polygons with the density of people look into Madina
\ No newline at end of file
@@ -1,13 +1,17 @@
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import trackintel as ti
-import lib.network as net
+import lib.compact_network as cnet
+import lib.map_matching as mm
+import lib.geometry as geo
 
-from shapely.geometry import Point, LineString
+from shapely.geometry import LineString
 from pyproj import CRS
 
 def convert_to_segments(pfs: ti.Positionfixes):
     data_segments = []
+    paths = geo.RaggedPaths()
 
     pfs.sort_values(by='tracked_at')
     for i in range(len(pfs) - 1):
@@ -18,19 +22,24 @@ def convert_to_segments(pfs: ti.Positionfixes):
         t1 = pfs.iloc[i]['tracked_at']
         t2 = pfs.iloc[i + 1]['tracked_at']
 
+        # Anchors of compressed stationary runs are stationary until they are left
+        stay = _stationary_segment(pfs, i)
+        if stay is not None:
+            data_segments.append(stay)
+            paths.append([], fallback=stay['geom'])
+            t1 = stay['finished_at']
+
         # Calculate distance, duration and avarage speed between two fixes
         try:
-            distance, path = net.distance(p1, p2)
+            distance, path = cnet.distance(p1, p2)
         except:
             continue
 
         duration = (t2 - t1).total_seconds()
         average_speed = distance / duration if duration > 0 else 0
 
-        # Constructing the path through street map
-        path_coord = [(net.graph.nodes[node]['x'], net.graph.nodes[node]['y']) for node in path]
-        path = LineString(path_coord) if len(path_coord) > 1 else p1
-        # path = LineString([p1, p2])
+        # The path through street map is kept, its geometry is created with all the others
+        paths.append(path, fallback=p1)
 
         segment = {
             'user_id': pfs.iloc[i]['user_id'],
@@ -39,11 +48,72 @@ def convert_to_segments(pfs: ti.Positionfixes):
             'distance': distance,
             'duration': duration,
             'avg_speed': average_speed,
-            'geom': path
         }
         data_segments.append(segment)
 
-    return data_segments
+    stay = _stationary_segment(pfs, len(pfs) - 1) if len(pfs) else None
+    if stay is not None:
+        data_segments.append(stay)
+        paths.append([], fallback=stay['geom'])
+
+    return _with_geometries(data_segments, paths)
+
+def convert_to_matched_segments(pfs: ti.Positionfixes, radius=50, sigma=10, beta=50):
+    """
+    Build the data segments of a user-day from the map-matched trajectory instead of
+    snapping every fix on its own, the output has the same schema as convert_to_segments.
+
+    Parameters:
+        pfs (Positionfixes): Position fixes of one user for one day.
+        radius, sigma, beta (float): Parameters of the map matching, see map_matching.match_trajectory.
+
+    Returns:
+        list: List of data segments represented as dictionaries.
+    """
+    data_segments = []
+    routes = geo.RaggedPaths()
+
+    pfs = pfs.sort_values(by='tracked_at')
+    _, distances, paths = mm.match_trajectory(pfs, radius, sigma, beta)
+
+    for i in range(len(pfs) - 1):
+        t1 = pfs.iloc[i]['tracked_at']
+        t2 = pfs.iloc[i + 1]['tracked_at']
+
+        # Anchors of compressed stationary runs are stationary until they are left
+        stay = _stationary_segment(pfs, i)
+        if stay is not None:
+            data_segments.append(stay)
+            routes.append([], fallback=stay['geom'])
+            t1 = stay['finished_at']
+
+        # Pairs of fixes without any route on the map are skipped
+        if paths[i] is None:
+            continue
+
+        distance = distances[i]
+        duration = (t2 - t1).total_seconds()
+        average_speed = distance / duration if duration > 0 else 0
+
+        # The matched path through street map is kept, its geometry is created with all the others
+        routes.append(paths[i], fallback=pfs.iloc[i]['geom'])
+
+        segment = {
+            'user_id': pfs.iloc[i]['user_id'],
+            'started_at': t1,
+            'finished_at': t2,
+            'distance': distance,
+            'duration': duration,
+            'avg_speed': average_speed,
+        }
+        data_segments.append(segment)
+
+    stay = _stationary_segment(pfs, len(pfs) - 1) if len(pfs) else None
+    if stay is not None:
+        data_segments.append(stay)
+        routes.append([], fallback=stay['geom'])
+
+    return _with_geometries(data_segments, routes)
 
 def merge_segments(segments, v_thresh=0.6):
     """
@@ -126,13 +196,151 @@ def adjust_status(merged_segments, t_thresh=30, d_thresh=300):
     return adjusted_gdf
 
 
+# -------------------------------------------------------------- #
+#                   PRE-ROUTING COMPRESSION                      #
+# -------------------------------------------------------------- #
+
+def compress_positionfixes(pfs: ti.Positionfixes, stay_radius=20, stay_time=300, tolerance=10, v_thresh=0.6):
+    """
+    Compress the position fixes of a user-day before segmentation, so that fewer pairs of
+    fixes have to be routed. Stationary runs are collapsed into their first fix, which keeps
+    the time the run ended in 'tracked_until', and the moving parts are simplified with a
+    time-aware Douglas-Peucker (synchronized euclidean distance).
+
+    Parameters:
+        pfs (Positionfixes): Position fixes of one user for one day.
+        stay_radius (float): Distance in meters from the first fix of a run within which the phone is stationary.
+        stay_time (float): Minimal duration in seconds of a run to be collapsed, shorter runs are slow movement.
+        tolerance (float): Maximal distance in meters between a removed fix and its time-interpolated position.
+        v_thresh (float): Speed threshold in m/s of merge_segments, fixes where the speed crosses it are kept.
+
+    Returns:
+        Positionfixes: The kept position fixes with the additional 'tracked_until' column.
+    """
+    pfs = pfs.sort_values(by='tracked_at')
+    n = len(pfs)
+
+    if n == 0:
+        return pfs.assign(tracked_until=pfs['tracked_at'])
+
+    # Local projection of the coordinates in meters, accurate enough at the scale of a city
+    lon = pfs['geom'].x.to_numpy()
+    lat = pfs['geom'].y.to_numpy()
+    xs = np.radians(lon - lon.mean()) * np.cos(np.radians(lat.mean())) * mm.EARTH_RADIUS
+    ys = np.radians(lat - lat.mean()) * mm.EARTH_RADIUS
+    ts = (pfs['tracked_at'] - pfs['tracked_at'].iloc[0]).dt.total_seconds().to_numpy()
+
+    # Collapsing the stationary runs, every run is represented by its first fix. A run has to
+    # last at least stay_time, otherwise its first fix is a moving one and the next run is tried
+    starts, ends = [], []
+    i = 0
+    while i < n:
+        j = i + 1
+        while j < n and np.hypot(xs[j] - xs[i], ys[j] - ys[i]) <= stay_radius:
+            j += 1
+
+        if ts[j - 1] - ts[i] < stay_time:
+            j = i + 1
+
+        starts.append(i)
+        ends.append(j - 1)
+        i = j
+
+    starts, ends = np.array(starts), np.array(ends)
+    xs, ys, t_start, t_end = xs[starts], ys[starts], ts[starts], ts[ends]
+
+    # The anchors and the first and last fixes are always kept
+    keep = np.zeros(len(starts), dtype=bool)
+    keep[[0, -1]] = True
+    keep[starts != ends] = True
+
+    # The fixes where the speed goes over or under v_thresh are kept, so the statuses do not change
+    if len(starts) > 2:
+        duration = t_start[1:] - t_end[:-1]
+        speed = np.hypot(np.diff(xs), np.diff(ys)) / np.where(duration > 0, duration, np.inf)
+        moving = speed > v_thresh
+        keep[1:-1] |= moving[1:] != moving[:-1]
+
+    # The moving fixes in between are simplified
+    fixed = np.flatnonzero(keep)
+    for first, last in zip(fixed[:-1], fixed[1:]):
+        _simplify(xs, ys, t_start, t_end, first, last, tolerance, keep)
+
+    compressed = pfs.iloc[starts[keep]].copy()
+    compressed['tracked_until'] = pfs['tracked_at'].iloc[ends[keep]].to_numpy()
+
+    return compressed
+
+def _simplify(xs, ys, t_start, t_end, first, last, tolerance, keep):
+    stack = [(first, last)]
+
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+
+        # Position where the phone would be at each time moving with a constant speed from a to b
+        inner = np.arange(a + 1, b)
+        span = t_start[b] - t_end[a]
+        ratio = (t_start[inner] - t_end[a]) / span if span > 0 else np.zeros(len(inner))
+
+        x = xs[a] + ratio * (xs[b] - xs[a])
+        y = ys[a] + ratio * (ys[b] - ys[a])
+        errors = np.hypot(xs[inner] - x, ys[inner] - y)
+
+        worst = int(np.argmax(errors))
+        if errors[worst] > tolerance:
+            keep[inner[worst]] = True
+            stack.extend([(a, inner[worst]), (inner[worst], b)])
+
+def _with_geometries(data_segments, paths):
+    # Geometries of all the segments, created at once when the segments are returned
+    for segment, geom in zip(data_segments, paths.to_geometries()):
+        segment['geom'] = geom
+
+    return data_segments
+
+def _stationary_segment(pfs, i):
+    # Stationary segment of a compressed anchor, None for fixes that are not anchors
+    if 'tracked_until' not in pfs.columns:
+        return None
+
+    started_at = pfs.iloc[i]['tracked_at']
+    finished_at = pfs.iloc[i]['tracked_until']
+
+    if finished_at <= started_at:
+        return None
+
+    return {
+        'user_id': pfs.iloc[i]['user_id'],
+        'started_at': started_at,
+        'finished_at': finished_at,
+        'distance': 0,
+        'duration': (finished_at - started_at).total_seconds(),
+        'avg_speed': 0,
+        'geom': pfs.iloc[i]['geom']
+    }
+
+
 # -------------------------------------------------------------- #
 #                  MAIN SEGMENTATIUON FUNCTIONS                  #
 # -------------------------------------------------------------- #
 
-def segregate(pfs: ti.Positionfixes, v_thresh=0.6, t_thresh=30, d_thresh=300):
-    segments = convert_to_segments(pfs)
-    segments = merge_segments(segments, v_thresh)
+def segregate(pfs: ti.Positionfixes, v_thresh=0.6, t_thresh=30, d_thresh=300, method='pairwise',
+              compress=True, stay_radius=20, stay_time=300, tolerance=10, **matching):
+    # Stationary runs and redundant moving fixes are removed before any routing
+    if compress:
+        pfs = compress_positionfixes(pfs, stay_radius, stay_time, tolerance, v_thresh)
+
+    # 'pairwise' routes every pair of fixes on its own, 'hmm' map-matches the whole trajectory
+    if method == 'pairwise':
+        segments = convert_to_segments(pfs)
+    elif method == 'hmm':
+        segments = convert_to_matched_segments(pfs, **matching)
+    else:
+        raise ValueError(f"Unknown segmentation method '{method}', use 'pairwise' or 'hmm'")
+
+    segments = merge_segments(pd.DataFrame(segments), v_thresh)
     segments = adjust_status(segments, t_thresh, d_thresh)
     
     return gpd.GeoDataFrame(segments, geometry='geom')
@@ -167,9 +375,6 @@ def split_segments_by_date(gdf):
 
     # Iterate over groups
     for date, group in grouped:
-        # Convert 'geom' column to Shapely geometry objects
-        group['geom'] = group['geom'].apply(lambda x: Point(x.x, x.y) if x.geom_type == 'Point' else LineString(x.coords))
-        
         # Convert DataFrame to GeoDataFrame
         gdf = gpd.GeoDataFrame(group, geometry='geom')
         
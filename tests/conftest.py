@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+import geopandas as gpd
+import pytest
+
+import lib.compact_network as cnet
+import lib.map_matching as mm
+
+from shapely.geometry import Point
+
+# Synthetic street grid around Yerevan with one node every 5 meters
+STEP = 5
+LON0, LAT0 = 44.5, 40.18
+DLAT = STEP / cnet.METERS_PER_DEGREE
+DLON = DLAT / np.cos(np.radians(LAT0))
+
+
+def node_point(col, row):
+    return Point(LON0 + col * DLON, LAT0 + row * DLAT)
+
+
+def make_pfs(cols, rows, times, user_id='u'):
+    return gpd.GeoDataFrame({
+        'user_id': user_id,
+        'tracked_at': pd.to_datetime(times, utc=True),
+    }, geometry=[node_point(c, r) for c, r in zip(cols, rows)], crs=4326).rename_geometry('geom')
+
+
+def grid_network(cols=400, rows=3):
+    graph = nx.MultiDiGraph()
+
+    for c in range(cols):
+        for r in range(rows):
+            p = node_point(c, r)
+            graph.add_node(c * rows + r, x=p.x, y=p.y)
+
+    for c in range(cols):
+        for r in range(rows):
+            for dc, dr in ((1, 0), (0, 1)):
+                if c + dc < cols and r + dr < rows:
+                    a, b = c * rows + r, (c + dc) * rows + r + dr
+                    length = float(mm.haversine(graph.nodes[a]['x'], graph.nodes[a]['y'],
+                                                graph.nodes[b]['x'], graph.nodes[b]['y']))
+                    graph.add_edge(a, b, length=length)
+                    graph.add_edge(b, a, length=length)
+
+    return graph
+
+
+@pytest.fixture(scope='session')
+def grid_graph(tmp_path_factory):
+    return cnet.build(grid_network(), str(tmp_path_factory.mktemp('graph') / 'grid'))
+
+
+@pytest.fixture
+def shared_graph(grid_graph, monkeypatch):
+    # The grid is used as the graph shared by the process instead of the Yerevan one
+    monkeypatch.setattr(cnet, '_graph', grid_graph)
+    return grid_graph
@@ -0,0 +1,140 @@
+import os
+import time
+import threading
+import numpy as np
+import networkx as nx
+import osmnx as ox
+
+import lib.compact_network as cnet
+
+from conftest import grid_network
+
+
+def irregular_network(seed=0):
+    # Grid with detours (edges longer than the straight line), missing streets and one-way streets
+    rng = np.random.default_rng(seed)
+    graph = grid_network(30, 30)
+
+    for u, v, data in graph.edges(data=True):
+        data['length'] *= 1 + 2 * rng.random()
+
+    edges = list(graph.edges(keys=True))
+    for i in rng.choice(len(edges), len(edges) // 5, replace=False):
+        graph.remove_edge(*edges[i])
+
+    graph.graph['crs'] = 'epsg:4326'
+    return graph
+
+
+def test_shortest_path_matches_networkx(tmp_path):
+    network = irregular_network()
+    graph = cnet.build(network, str(tmp_path / 'graph'))
+    node_ids = graph.node_ids.tolist()
+
+    rng = np.random.default_rng(1)
+    for orig, target in rng.integers(len(graph), size=(300, 2)).tolist():
+        try:
+            expected = nx.shortest_path_length(network, node_ids[orig], node_ids[target], weight='length')
+        except nx.NetworkXNoPath:
+            expected = None
+
+        try:
+            dist, path = graph.shortest_path(orig, target)
+        except ValueError:
+            dist, path = None, None
+
+        if expected is None:
+            assert dist is None
+            continue
+
+        assert np.isclose(dist, expected)
+        assert path[0] == orig and path[-1] == target
+        assert np.isclose(sum(min(d['length'] for d in network[node_ids[a]][node_ids[b]].values())
+                              for a, b in zip(path[:-1], path[1:])), dist)
+
+
+def test_nearest_nodes_match_osmnx(tmp_path):
+    network = irregular_network()
+    graph = cnet.build(network, str(tmp_path / 'graph'))
+
+    rng = np.random.default_rng(2)
+    xs = rng.uniform(graph.node_x.min(), graph.node_x.max(), 500)
+    ys = rng.uniform(graph.node_y.min(), graph.node_y.max(), 500)
+
+    assert graph.osm_ids(graph.nearest_nodes(xs, ys)) == list(ox.distance.nearest_nodes(network, xs, ys))
+
+
+def test_short_routes_are_faster_than_networkx(tmp_path):
+    # The search stops at the target, a short route does not depend on the size of the graph
+    network = grid_network(100, 100)
+    graph = cnet.build(network, str(tmp_path / 'graph'))
+
+    rng = np.random.default_rng(3)
+    origins = rng.integers(0, 96, size=(200, 2))
+    pairs = [(c * 100 + r, (c + dc) * 100 + r + dr) for (c, r), (dc, dr) in zip(origins, rng.integers(0, 4, size=(200, 2)))]
+
+    start = time.perf_counter()
+    for orig, target in pairs:
+        graph.shortest_path(orig, target)
+    compact = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for orig, target in pairs:
+        nx.shortest_path(network, orig, target, weight='length')
+        nx.shortest_path_length(network, orig, target, weight='length')
+    networkx = time.perf_counter() - start
+
+    assert compact < networkx
+
+
+def test_stale_arrays_are_rebuilt(tmp_path, monkeypatch):
+    monkeypatch.setattr(cnet, '_graph', None)
+    path = str(tmp_path / 'graph')
+
+    network = irregular_network()
+    first = cnet.load(path, network)
+    version = os.path.realpath(path)
+
+    # The same graph is loaded from the published arrays
+    monkeypatch.setattr(cnet, '_graph', None)
+    assert np.array_equal(cnet.load(path, network).lengths, first.lengths)
+    assert os.path.realpath(path) == version
+
+    changed = irregular_network(seed=1)
+    second = cnet.load(path, changed)
+
+    assert os.path.islink(path) and os.path.realpath(path) != version
+    assert not os.path.exists(version)
+    assert not np.array_equal(second.lengths, first.lengths)
+
+    # The arrays mapped before the rebuild are still readable
+    assert float(first.lengths.sum()) > 0
+
+
+def test_publish_replaces_graph_without_gap(tmp_path):
+    path = str(tmp_path / 'graph')
+    os.makedirs(path)  # directory of the graph built before the versions
+    networks = [irregular_network(seed) for seed in range(2)]
+
+    missing = []
+    done = threading.Event()
+
+    def rebuild():
+        for i in range(20):
+            cnet.build(networks[i % 2], path)
+        done.set()
+
+    cnet.build(networks[0], path)
+    thread = threading.Thread(target=rebuild)
+    thread.start()
+
+    # A version removed right after it was resolved is not a gap, the link already points to the next one
+    while not done.is_set():
+        version = os.path.realpath(path)
+        if cnet._read_meta(version) is None and os.path.realpath(path) == version:
+            missing.append(version)
+
+    thread.join()
+
+    assert not missing
+    assert len(os.listdir(tmp_path)) == 2  # the link and the current version
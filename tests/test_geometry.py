@@ -0,0 +1,49 @@
+import lib.compact_network as cnet
+import lib.geometry as geo
+
+from shapely.geometry import Point
+
+
+def test_path_geometries(grid_graph):
+    paths = geo.RaggedPaths()
+    paths.append([0, 3, 6])
+    paths.append([9], fallback=Point(1, 2))
+    paths.append([])
+    paths.append([], fallback=Point(3, 4))
+    paths.append([4, 7])
+
+    geoms = paths.to_geometries(grid_graph)
+
+    assert list(geoms[0].coords) == grid_graph.path_coords([0, 3, 6])
+    assert geoms[1].equals(Point(1, 2)) and geoms[3].equals(Point(3, 4))
+    assert geoms[2].is_empty and geoms[2].geom_type == 'LineString'
+    assert list(geoms[4].coords) == grid_graph.path_coords([4, 7])
+
+
+def test_paths_without_lines_do_not_load_the_graph(monkeypatch):
+    def load(*args, **kwargs):
+        raise AssertionError('the graph is loaded')
+
+    monkeypatch.setattr(cnet, 'load', load)
+
+    assert len(geo.path_geometries(geo.RaggedPaths())) == 0
+
+    paths = geo.RaggedPaths()
+    paths.append([5], fallback=Point(1, 2))
+    assert paths.to_geometries()[0].equals(Point(1, 2))
+
+
+def test_extend_joins_paths():
+    paths = geo.RaggedPaths()
+    paths.append([1, 2])
+    paths.append([])
+    paths.extend([3, 4])
+    paths.extend([4, 5, 6])
+
+    assert paths[1].tolist() == [3, 4, 5, 6]
+    assert paths.lengths().tolist() == [2, 4]
+
+    # The arrays are built again only after a change
+    assert paths.nodes is paths.nodes
+    paths.append([7])
+    assert paths[2].tolist() == [7]
@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import networkx as nx
+import geopandas as gpd
+import pytest
+
+import lib.compact_network as cnet
+import lib.map_matching as mm
+import lib.segmentation as sg
+
+from conftest import node_point, STEP
+
+
+def jittered_track(cols, row, noise, seed=0):
+    # Fixes every 2 steps along a street, with GPS noise of noise meters in both directions
+    rng = np.random.default_rng(seed)
+    jitter = rng.normal(0, noise / STEP, size=(len(cols), 2))
+    points = [node_point(c + dc, row + dr) for c, (dc, dr) in zip(cols, jitter)]
+    times = pd.date_range('2021-03-01 10:00', periods=len(cols), freq='5s', tz='UTC')
+
+    return gpd.GeoDataFrame({'user_id': 'u', 'tracked_at': times}, geometry=points, crs=4326).rename_geometry('geom')
+
+
+def assert_monotone(graph, matched, paths, noise):
+    # The route never turns back, the matched fixes only move back by the GPS noise
+    assert all(np.all(np.diff(graph.node_x[path]) >= 0) for path in paths if path)
+
+    position = [graph.node_x[u] + t * (graph.node_x[v] - graph.node_x[u]) for u, v, t in matched]
+    assert np.all(np.diff(position) * cnet.METERS_PER_DEGREE * np.cos(np.radians(40.18)) >= -3 * noise)
+
+
+def test_jittered_track_on_grid(grid_graph):
+    cols = np.arange(0, 200, 2)
+    pfs = jittered_track(cols, 1, noise=1.5)  # below half of the distance between the streets
+
+    matched, distances, paths = mm.match_trajectory(pfs, radius=20, graph=grid_graph)
+
+    assert None not in distances and None not in paths
+    assert_monotone(grid_graph, matched, paths, 1.5)
+    assert sum(distances) == pytest.approx((cols[-1] - cols[0]) * STEP, rel=0.05)
+
+
+def test_fixes_mid_block_are_matched_on_the_street(tmp_path):
+    # Two parallel streets 60 m apart with intersections every 200 m only
+    network = nx.MultiDiGraph()
+    for c in range(6):
+        for r in range(2):
+            p = node_point(c * 40, r * 12)
+            network.add_node(c * 2 + r, x=p.x, y=p.y)
+
+    for a, b in [(c * 2 + r, (c + 1) * 2 + r) for c in range(5) for r in range(2)] + [(c * 2, c * 2 + 1) for c in range(6)]:
+        length = float(mm.haversine(network.nodes[a]['x'], network.nodes[a]['y'], network.nodes[b]['x'], network.nodes[b]['y']))
+        network.add_edge(a, b, length=length)
+        network.add_edge(b, a, length=length)
+
+    graph = cnet.build(network, str(tmp_path / 'graph'))
+
+    # Fixes from 50 m to 750 m along the first street, most of them further than radius from any node
+    cols = np.arange(10, 152, 2)
+    matched, distances, paths = mm.match_trajectory(jittered_track(cols, 0, noise=3, seed=1), radius=30, graph=graph)
+
+    assert all({u, v} <= set(range(0, 12, 2)) for u, v, _ in matched)
+    assert_monotone(graph, matched, paths, 3)
+    assert sum(distances) == pytest.approx((cols[-1] - cols[0]) * STEP, rel=0.05)
+
+
+def test_matched_segments(shared_graph):
+    cols = np.arange(0, 200, 2)
+    segments = pd.DataFrame(sg.convert_to_matched_segments(jittered_track(cols, 1, noise=1.5), radius=20))
+
+    assert len(segments) == len(cols) - 1
+    assert segments['distance'].sum() == pytest.approx((cols[-1] - cols[0]) * STEP, rel=0.05)
+    assert segments['geom'].notna().all()
@@ -0,0 +1,66 @@
+import asyncio
+import pandas as pd
+import geopandas as gpd
+
+import lib.occupancy as oc
+
+from shapely.geometry import box
+
+START = pd.Timestamp('2021-06-01 09:00', tz='UTC')
+
+# Two red line polygons (about 85 x 110 meters) and a point outside of both
+POLYGONS = gpd.GeoDataFrame({'id': [1, 2]}, geometry=[box(44.500, 40.180, 44.501, 40.181),
+                                                      box(44.510, 40.180, 44.511, 40.181)], crs=4326)
+INSIDE = {1: (40.1805, 44.5005), 2: (40.1805, 44.5105), None: (40.19, 44.52)}
+
+
+def fixes(device, polygon, seconds):
+    lat, lon = INSIDE[polygon]
+    return [{'identifier': device, 'timestamp': START + pd.Timedelta(seconds=s),
+             'device_lat': lat, 'device_lon': lon} for s in seconds]
+
+
+def write_replay(path, rows):
+    df = pd.DataFrame(rows).sort_values('timestamp')
+    df.to_csv(path, index=False)
+
+
+def test_replay_counts_dwell_and_expiry(tmp_path):
+    path = tmp_path / 'replay.csv'
+    write_replay(path, fixes('a', 1, range(0, 601, 60)) + fixes('b', 2, range(0, 301, 60))
+                 + fixes('b', None, [360]) + fixes('c', 1, [0]) + fixes('d', None, [120]))
+
+    estimator = oc.OccupancyEstimator(POLYGONS, window=900, idle_timeout=1800)
+    ingested = asyncio.run(oc.run(estimator, oc.replay_csv(path, batch_size=5)))
+
+    assert ingested == 20
+    assert estimator.counts() == {1: 2, 2: 1}
+    assert estimator.dwell('a') == 600
+    assert estimator.dwell('b') is None
+    assert estimator.dwell('c') == 0
+
+    # Much later only 'a' is still reporting, the others are idle and expire
+    write_replay(path, fixes('a', 1, [2400]))
+    asyncio.run(oc.run(estimator, oc.replay_csv(path)))
+
+    assert estimator.counts() == {1: 1}
+    assert set(estimator.devices) == {'a'}
+    assert estimator.dwell('a') == 2400
+
+
+def test_tail_file_started_on_empty_file(tmp_path):
+    path = tmp_path / 'live.csv'
+    path.write_text('')
+
+    async def tail():
+        # The tail is already polling the empty file when the header and the fixes are written
+        batch = asyncio.create_task(anext(oc.tail_file(path, poll=0.01)))
+        await asyncio.sleep(0.05)
+
+        write_replay(path, fixes('a', 1, [0, 60]))
+        return await asyncio.wait_for(batch, 5)
+
+    batch = asyncio.run(tail())
+
+    assert batch['user_id'].tolist() == ['a', 'a']
+    assert list(batch.columns) == ['user_id', 'tracked_at', 'latitude', 'longitude']
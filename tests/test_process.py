@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+import lib.process as prcs
+
+from shapely.geometry import Point
+
+
+def random_fixes(rng, users, n, column, days=10):
+    times = pd.Timestamp('2021-01-01', tz='UTC') + pd.to_timedelta(rng.integers(0, days * 86400, n), unit='s')
+
+    return gpd.GeoDataFrame({'user_id': rng.choice(users, n), column: times},
+                            geometry=[Point(44.5, 40.18)] * n, crs=4326).rename_geometry('geom')
+
+
+def clean_person(person):
+    # Per person cleaning, as it was done before the tables were cleaned at once
+    sp, pfs = person.sp, person.pfs
+    days = sp['started_at'].dt.date
+    removed = days[days.map(days.value_counts()) == 1].unique()
+
+    return pfs[~pfs['tracked_at'].dt.date.isin(removed)], sp[~days.isin(removed)]
+
+
+def test_clean_staypoints_matches_per_person_cleaning():
+    rng = np.random.default_rng(0)
+    pfs = random_fixes(rng, ['a', 'b', 'c', 'd'], 2000, 'tracked_at')
+    sp = random_fixes(rng, ['a', 'b', 'c', 'e'], 60, 'started_at')
+
+    people = prcs.extract_people(pfs)
+    assert prcs.update_staypoints(people, sp) is people
+
+    expected = {}
+    for person in people:
+        if person.sp is not None:
+            p, s = clean_person(person)
+            if not p.empty and not s.empty:
+                expected[person.id] = (len(p), len(s))
+
+    cleaned = prcs.clean_staypoints(people)
+
+    assert isinstance(cleaned, prcs.PeopleStore)
+    assert {person.id: (len(person.pfs), len(person.sp)) for person in cleaned} == expected
+    assert all(any(person is other for other in people) for person in cleaned)
+
+
+def test_store_keeps_person_state():
+    rng = np.random.default_rng(1)
+    store = prcs.PeopleStore(random_fixes(rng, ['a', 'b'], 100, 'tracked_at'))
+
+    store[0].tpls = 'triplegs'
+    for person in store:
+        person.sp = 'staypoints'
+
+    assert store[0].tpls == 'triplegs'
+    assert store.get('b').sp == 'staypoints'
+
+    # New tables are given to the same people when they are accessed again
+    person = store[0]
+    store.set_tables(store.pfs.iloc[:10])
+    assert store.get(person.id) is person and len(person.pfs) == 10 and person.tpls == 'triplegs'
+
+
+def test_cleaning_a_store_builds_no_people(monkeypatch):
+    rng = np.random.default_rng(3)
+    store = prcs.PeopleStore(random_fixes(rng, np.arange(500), 5000, 'tracked_at'),
+                             random_fixes(rng, np.arange(500), 1000, 'started_at'))
+
+    built = []
+    init = prcs.Person.__init__
+    monkeypatch.setattr(prcs.Person, '__init__', lambda self, *args: built.append(init(self, *args)))
+
+    cleaned = prcs.clean_staypoints(store)
+    assert cleaned is store and not built
+
+    # People are built on access, with the cleaned tables
+    person = cleaned[0]
+    assert len(built) == 1
+    assert person.pfs['user_id'].eq(person.id).all() and len(person.pfs) == len(store.pfs.loc[store.pfs['user_id'] == person.id])
+
+
+def test_memory_report_estimates_geometries():
+    rng = np.random.default_rng(2)
+    pfs = random_fixes(rng, ['a', 'b'], 1000, 'tracked_at')
+
+    report = prcs.memory_report(pfs, rows=10 ** 6)
+
+    assert report.loc['geom', 'estimated'] and report.loc['total', 'estimated']
+    assert report.loc['geom', 'bytes_per_row'] >= prcs.POINT_BYTES
+    assert not report.loc['tracked_at', 'estimated']
+
+
+def test_memory_report_of_compact_frame(monkeypatch):
+    rng = np.random.default_rng(4)
+    pfs = random_fixes(rng, ['a', 'b'], 1000, 'tracked_at')
+    compact = prcs.compact_positionfixes(pfs)
+    compact['geom'] = pfs['geom'].to_numpy()  # geometries in an object column
+
+    # Only the object column is checked for geometries, the numeric and categorical ones are not boxed
+    checked = []
+    is_geometry = prcs.shapely.is_geometry
+    monkeypatch.setattr(prcs.shapely, 'is_geometry', lambda values: checked.append(len(values)) or is_geometry(values))
+
+    report = prcs.memory_report(compact)
+
+    assert report['estimated'].tolist() == [False] * 5 + [True, True]
+    assert checked == [100, 1000]
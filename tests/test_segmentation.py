@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import lib.compact_network as cnet
+import lib.segmentation as sg
+
+from conftest import make_pfs
+
+
+def merged(pfs):
+    return sg.merge_segments(pd.DataFrame(sg.convert_to_segments(pfs)))
+
+
+def count_routing(monkeypatch):
+    calls = []
+    distance = cnet.distance
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return distance(*args, **kwargs)
+
+    monkeypatch.setattr(cnet, 'distance', counted)
+    return calls
+
+
+def test_compression_keeps_steady_walk(shared_graph):
+    # 1.5 m/s walk, one fix every 10 s (15 m), slower than a stay would need to be collapsed
+    n = 100
+    pfs = make_pfs(np.arange(n) * 3, [1] * n, pd.date_range('2021-03-01 10:00', periods=n, freq='10s'))
+
+    plain = merged(pfs)
+    compressed = merged(sg.compress_positionfixes(pfs))
+
+    assert compressed['status'].tolist() == plain['status'].tolist() == [1]
+    assert compressed['distance'].sum() == pytest.approx(plain['distance'].sum())
+    assert compressed['avg_speed'].tolist() == pytest.approx(plain['avg_speed'].tolist())
+
+
+def test_compression_keeps_statuses_of_drive_with_stop(shared_graph, monkeypatch):
+    # Drive at 10 m/s, park for 10 minutes and drive again
+    drive = np.arange(30) * 10
+    cols = np.r_[drive, np.full(20, drive[-1]), drive[-1] + 10 + np.arange(5) * 10]
+    times = np.r_[
+        pd.date_range('2021-03-01 10:00', periods=30, freq='5s'),
+        pd.date_range('2021-03-01 10:03:00', periods=20, freq='30s'),
+        pd.date_range('2021-03-01 10:13:00', periods=5, freq='5s'),
+    ]
+    pfs = make_pfs(cols, [1] * len(cols), times)
+
+    calls = count_routing(monkeypatch)
+    plain = merged(pfs)
+    plain_calls = len(calls)
+
+    calls.clear()
+    compressed = merged(sg.compress_positionfixes(pfs))
+
+    assert compressed['status'].tolist() == plain['status'].tolist()
+    assert compressed['distance'].tolist() == pytest.approx(plain['distance'].tolist())
+    assert compressed['duration'].tolist() == pytest.approx(plain['duration'].tolist())
+    assert len(calls) < plain_calls / 5
+
+
+def test_compression_of_empty_day(shared_graph):
+    pfs = make_pfs([], [], pd.DatetimeIndex([]))
+
+    assert sg.convert_to_segments(sg.compress_positionfixes(pfs)) == []